@@ -0,0 +1,139 @@
+import sys, os, re
+from conv import *
+from exoquant import ExoQuant
+from verify import compare, masked, find_textures
+
+CI4_COLORS = 0x10
+# A 256 entry TLUT holds 16 CI4 palettes
+TLUT_BANKS = 0x10
+
+def palette_colors(exq):
+    # Quantized colors with their pixel counts, in ExoQuant color space
+    return [
+        ((node.avg.r, node.avg.g, node.avg.b, node.avg.a), node.num)
+        for node in exq.pExq.node[:exq.pExq.numColors]
+        if node.num > 0
+    ]
+
+def color_cost(colors, palette):
+    # Pixel weighted squared error of mapping colors to the closest palette entry
+    cost = 0.0
+    for col, num in colors:
+        cost += num * min(
+            (col[0] - p[0]) ** 2 + (col[1] - p[1]) ** 2 +
+            (col[2] - p[2]) ** 2 + (col[3] - p[3]) ** 2
+            for p, _ in palette)
+    return cost
+
+def merge_cost(a, b):
+    return color_cost(a, b) + color_cost(b, a)
+
+def cluster(palettes, n_banks):
+    # Greedy agglomerative clustering, always merging the two clusters
+    # whose colors are cheapest to represent with each other's colors
+    clusters = [([i], list(pal)) for i, pal in enumerate(palettes)]
+    costs = {}
+    while len(clusters) > n_banks:
+        best = None
+        for i in range(len(clusters)):
+            for j in range(i + 1, len(clusters)):
+                key = (tuple(clusters[i][0]), tuple(clusters[j][0]))
+                if key not in costs:
+                    costs[key] = merge_cost(clusters[i][1], clusters[j][1])
+                if best is None or costs[key] < best[0]:
+                    best = (costs[key], i, j)
+        _, i, j = best
+        merged = (clusters[i][0] + clusters[j][0], clusters[i][1] + clusters[j][1])
+        clusters = [c for k, c in enumerate(clusters) if k not in (i, j)]
+        clusters.append(merged)
+    return sorted(c[0] for c in clusters)
+
+def mapped_rgba(rgba32_palette, index_data):
+    # What the texture looks like through its RGBA16 palette
+    pal = [un5551(to5551([c[0], c[1], c[2], int(c[3])], lst=True)) for c in chunks(4, rgba32_palette)]
+    return bytearray(v for i in index_data for v in pal[i])
+
+def mapped_psnr(img_data, rgba32_palette, index_data):
+    # Transparent texel color isn't scored, like in verify
+    alpha = bytes(img_data[3::4])
+    return compare(masked(img_data, alpha), masked(mapped_rgba(rgba32_palette, index_data), alpha))[0]
+
+def bank_CI4(textures, n_banks=TLUT_BANKS, fmt=True):
+    # Share n_banks 16 color palettes between a set of CI4 textures.
+    # Returns the TLUT, each texture's (bank, indexes) and the
+    # (per-texture palette, banked palette) PSNR of every texture.
+    if not 0 < n_banks <= TLUT_BANKS:
+        raise ValueError(f'CI4 bank count must be between 1 and {TLUT_BANKS}')
+    sources = [tex.ci_source() for tex in textures]
+
+    own = []
+    for tex, img_data in zip(textures, sources):
+        exq = ExoQuant()
+        exq.feed(img_data)
+        exq.quantize(CI4_COLORS)
+        rgba32_palette = exq.get_palette(CI4_COLORS)
+        index_data = exq.map_image_ordered(tex.width, tex.height, img_data)
+        own.append((palette_colors(exq), mapped_psnr(img_data, rgba32_palette, index_data)))
+
+    groups = cluster([colors for colors, _ in own], n_banks)
+
+    tlut = []
+    banked = [None] * len(textures)
+    for bank, members in enumerate(groups):
+        exq = ExoQuant()
+        for i in members:
+            exq.feed(sources[i])
+        exq.quantize(CI4_COLORS)
+        rgba32_palette = exq.get_palette(CI4_COLORS)
+        tlut += rgba32_palette
+        for i in members:
+            tex = textures[i]
+            index_data = exq.map_image_ordered(tex.width, tex.height, sources[i])
+            psnr = mapped_psnr(sources[i], rgba32_palette, index_data)
+            banked[i] = (bank, index_to_byte_list(CI4_COLORS, index_data, fmt=fmt, width=tex.width, height=tex.height), psnr)
+
+    errors = [(own_psnr, b[2]) for (_, own_psnr), b in zip(own, banked)]
+    return (
+        palette_to_byte_list(tlut, fmt=fmt),
+        [(bank, idxs) for bank, idxs, _ in banked],
+        errors)
+
+
+def main():
+    args, opts = parse_opts(sys.argv[1:])
+    if not args or 'help' in opts or args[0].lower() in ['help', '-h']:
+        print('command <img or dir paths...> [--banks=N] [--out=<file.inc.c>]')
+        exit(0)
+
+    paths = list(find_textures(args))
+    if not paths:
+        print('No PNG textures found')
+        exit(1)
+    n_banks = int(opts.get('banks', TLUT_BANKS))
+    textures = []
+    for img_path in paths:
+        with Image.open(img_path) as img:
+            textures.append(N64Texture(img))
+
+    tlut, banks, errors = bank_CI4(textures, n_banks)
+
+    c_defs = [to_c_def('tlut', tlut, U16)]
+    for img_path, (bank, idxs), (own_psnr, bank_psnr) in zip(paths, banks, errors):
+        tex_name, _ = os.path.splitext(os.path.split(img_path)[-1])
+        tex_name = re.sub('[^0-9a-zA-Z\_]+', '', re.sub(' ', '_', f'{tex_name}_CI4'))
+        print(f'bank {bank:2d} psnr {own_psnr:6.2f} -> {bank_psnr:6.2f} {img_path}')
+        c_defs.append(f'#define {tex_name}_BANK {bank}\n')
+        c_defs.append(to_c_def(f'{tex_name}_indexes', idxs, U8))
+
+    own_mean = sum(e[0] for e in errors) / len(errors)
+    bank_mean = sum(e[1] for e in errors) / len(errors)
+    print(f'{len(textures)} textures in {len(set(b for b, _ in banks))} banks, '
+        f'mean psnr {own_mean:.2f} (own palettes) -> {bank_mean:.2f} (banked)')
+
+    output_fn = opts.get('out', 'tlut_CI4.inc.c')
+    with open(output_fn, 'w') as fp:
+        fp.write('\n'.join(c_defs))
+    print(f'Success! Data written to {output_fn}')
+
+if __name__ == "__main__":
+    main()
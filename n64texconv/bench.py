@@ -0,0 +1,116 @@
+import sys, os, json, time, tracemalloc
+from conv import *
+from decode import decode
+from verify import compare, mean_error, masked
+
+BENCH_SIZES = [32, 64, 128]
+DEFAULT_TOLERANCE = 0.1
+
+def synthetic(width, height, siz=U16, mem_budget=None):
+    # Deterministic test texture with a bounded number of colors
+    data = bytearray(width * height * 4)
+    for y in range(height):
+        for x in range(width):
+            i = (y * width + x) * 4
+            data[i:i + 4] = bytes([
+                (x & 0xF) << 4,
+                (y & 0xF) << 4,
+                ((x + y) & 0x3) << 6,
+                0xFF if (x ^ y) & 0x8 else 0x80])
+    return N64Texture.from_buffer(data, width, height, siz=siz, mem_budget=mem_budget)
+
+def convert_to_c(tex, fmt, fp):
+    if fmt in [CI4, CI8]:
+        palette, indexes = getattr(tex, f'to_{fmt}')()
+        write_c_defs(fp, [('pal', palette, U16), ('indexes', indexes, U8)])
+    else:
+        write_c_defs(fp, [('data', getattr(tex, f'to_{fmt}')(), tex.siz)])
+
+def measure(fmt, size, siz=U16, mem_budget=None):
+    # Peak traced memory and time of one conversion written out as C
+    tex = synthetic(size, size, siz=siz, mem_budget=mem_budget)
+    with open(os.devnull, 'w') as fp:
+        tracemalloc.start()
+        start = time.perf_counter()
+        convert_to_c(tex, fmt, fp)
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return (peak, elapsed)
+
+def run(formats=FORMATS, sizes=BENCH_SIZES, siz=U16):
+    # Peak memory keyed by format/size/mode, the budget mode uses
+    # the smallest possible budget to force the low memory path
+    results = {}
+    for fmt in formats:
+        for size in sizes:
+            for mode, budget in [('default', None), ('budget', 0)]:
+                peak, elapsed = measure(fmt, size, siz=siz, mem_budget=budget)
+                results[f'{fmt}/{size}/{mode}'] = peak
+                print(f'{fmt:<6} {size:4d}x{size:<4d} {mode:<7} peak={peak / 1024:9.1f}KB time={elapsed:7.3f}s')
+    return results
+
+def compare_quantizers(tex, fmt=CI8, quantizers=None):
+    # Time and error of every quantizer against the texture's
+    # RGBA16 compressed source, after the same RGBA16 palette conversion.
+    # The color of transparent texels isn't scored, like in verify.
+    rows = []
+    source = tex.ci_source()
+    alpha = bytes(source[3::4])
+    source = masked(source, alpha)
+    for name in quantizers or available_quantizers():
+        start = time.perf_counter()
+        palette, indexes = getattr(tex, f'to_{fmt}')(fmt=False, quantizer=name)
+        elapsed = time.perf_counter() - start
+        rgba = masked(decode(fmt, indexes.data, tex.width, tex.height, palette=palette.data), alpha)
+        rows.append((name, elapsed, mean_error(source, rgba), compare(source, rgba)[0]))
+        print(f'{fmt:<4} {name:<18} time={elapsed:7.3f}s mean_err={rows[-1][2]:6.2f} psnr={rows[-1][3]:6.2f}')
+    return rows
+
+def regressions(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    return [
+        (key, baseline[key], peak)
+        for key, peak in results.items()
+        if key in baseline and peak > baseline[key] * (1 + tolerance)
+    ]
+
+
+def main():
+    args, opts = parse_opts(sys.argv[1:])
+    if 'help' in opts or (args and args[0].lower() in ['help', '-h']):
+        print('command [formats...] [--sizes=32,64,128] [--save=<json>] [--compare=<json>] [--tolerance=0.1]')
+        print('command --quantizers=<img path> [CI4|CI8] [--only=<quantizer,...>]')
+        print('\nFormats:')
+        print(', '.join(FORMATS))
+        exit(0)
+
+    formats = [a.upper() for a in args if a.upper() in FORMATS] or FORMATS
+    if 'quantizers' in opts:
+        with Image.open(opts['quantizers']) as img:
+            tex = N64Texture(img)
+        only = opts['only'].split(',') if 'only' in opts else None
+        for fmt in [f for f in formats if f in [CI4, CI8]] or [CI4, CI8]:
+            compare_quantizers(tex, fmt, only)
+        exit(0)
+
+    sizes = [int(s) for s in opts['sizes'].split(',')] if 'sizes' in opts else BENCH_SIZES
+    results = run(formats, sizes)
+
+    if 'save' in opts:
+        with open(opts['save'], 'w') as fp:
+            json.dump(results, fp, indent=4, sort_keys=True)
+        print(f'Results written to {opts["save"]}')
+
+    if 'compare' in opts:
+        with open(opts['compare'], 'r') as fp:
+            baseline = json.load(fp)
+        tolerance = float(opts.get('tolerance', DEFAULT_TOLERANCE))
+        failed = regressions(results, baseline, tolerance)
+        for key, before, after in failed:
+            print(f'REGRESSION {key}: {before / 1024:.1f}KB -> {after / 1024:.1f}KB')
+        if failed:
+            exit(1)
+        print(f'No peak memory regressions over {tolerance:.0%}')
+
+if __name__ == "__main__":
+    main()
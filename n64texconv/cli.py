@@ -1,30 +1,77 @@
 import sys, re
 from conv import *
+from compress import COMPRESSIONS, DEFAULT_LEVEL, compress_asset
+from exoquant import ExqStats
+from quantizers import QUANTIZERS
+from decode import parse_c_defs
 
 def main():
-    n_args = len(sys.argv)
-    if n_args > 1:
+    args, opts = parse_opts(sys.argv)
+    n_args = len(args)
+    if n_args > 1 or 'help' in opts:
 
-        img_path = sys.argv[1]
-        if img_path.lower() in ['help', '-h', '--help']:
-            print('command <img path> <format> <output size>')
+        img_path = args[1] if n_args > 1 else ''
+        if 'help' in opts or img_path.lower() in ['help', '-h']:
+            print('command <img path> <format> <output size> [--compress=<compression>] [--level=<1-9>] [--mem-budget=<bytes, K, M>] [--jobs=<CI histogram and mapping workers>] [--palette-from=<previous .inc.c>] [--stats] [--quantizer=<quantizer>] [--bin]')
             print('\nFormats:')
             print(', '.join(FORMATS))
             print('\nOutput sizes:')
             print(', '.join(SIZES))
+            print('\nCompressions:')
+            print(', '.join(COMPRESSIONS))
+            print('\nQuantizers:')
+            print(', '.join(available_quantizers()))
             exit(0)
 
+        compression = opts.get('compress', '').upper() or None
+        if compression and compression not in COMPRESSIONS:
+            print(f'Choose from the following compressions:')
+            print(', '.join(COMPRESSIONS))
+            exit(1)
+        level = int(opts.get('level', DEFAULT_LEVEL))
+        mem_budget = parse_size(opts['mem-budget']) if 'mem-budget' in opts else None
+        workers = int(opts['jobs']) if 'jobs' in opts else None
+        # Refine the palette of a previous CI conversion
+        prev_palette = None
+        if 'palette-from' in opts:
+            with open(opts['palette-from'], 'r') as fp:
+                pals = [v for k, v in parse_c_defs(fp.read()).items() if k.endswith('_pal')]
+            if not pals:
+                print(f'No palette array found in {opts["palette-from"]}')
+                exit(1)
+            prev_palette = pals[0]
+        quant_stats = ExqStats() if 'stats' in opts else None
+        quantizer = opts.get('quantizer', DEFAULT_QUANTIZER)
+        if quantizer not in available_quantizers():
+            print(f'Choose from the following quantizers:')
+            print(', '.join(available_quantizers()))
+            exit(1)
+        if quant_stats is not None and not QUANTIZERS[quantizer].stats_stages:
+            print(f'--stats is not available for the {quantizer} quantizer')
+            exit(1)
+        # Write raw big-endian .bin files instead of C arrays
+        write_bin = 'bin' in opts
+
         output_fmt = 'RGBA16'
         if n_args > 2:
-            output_fmt = sys.argv[2].upper()
+            output_fmt = args[2].upper()
             if output_fmt not in FORMATS:
                 print(f'Choose from the following formats:')
                 print(', '.join(FORMATS))
                 exit(1)
 
+        if prev_palette is not None:
+            if output_fmt not in [CI4, CI8]:
+                print('--palette-from only applies to CI4 and CI8')
+                exit(1)
+            n_colors = 0x10 if output_fmt == CI4 else 0x100
+            if len(prev_palette) // 2 != n_colors:
+                print(f'{opts["palette-from"]} has a {len(prev_palette) // 2} color palette, {output_fmt} needs {n_colors}')
+                exit(1)
+
         siz = U8
         if n_args > 3:
-            size_arg = sys.argv[3].upper()
+            size_arg = args[3].upper()
             if size_arg not in SIZES:
                 print(f'Choose from the following sizes:')
                 print(', '.join(SIZES))
@@ -43,42 +90,58 @@ def main():
 
         print(f'Creating {output_fmt} texture from {img_path}')
         with Image.open(img_path) as img:
-            n64_img = N64Texture(img, siz=siz)
+            n64_img = N64Texture(img, siz=siz, mem_budget=mem_budget)
+            if mem_budget is not None and n64_img.min_peak(output_fmt) > mem_budget:
+                print(f'Warning: {output_fmt} needs about {n64_img.min_peak(output_fmt) // 1024}KB '
+                    f'even in strips, over the {mem_budget // 1024}KB memory budget')
             palette, indexes, data = None, None, None
 
             if output_fmt == CI4:
-                palette, indexes = n64_img.to_CI4()
+                palette, indexes = n64_img.to_CI4(workers=workers, palette=prev_palette, stats=quant_stats, quantizer=quantizer)
             elif output_fmt == CI8:
-                palette, indexes = n64_img.to_CI8()
-            elif output_fmt == RGBA16:
-                data = n64_img.to_RGBA16()
-            elif output_fmt == RGBA32:
-                data = n64_img.to_RGBA32()
-            elif output_fmt == IA4:
-                data = n64_img.to_IA4()
-            elif output_fmt == IA8:
-                data = n64_img.to_IA8()
-            elif output_fmt == IA16:
-                data = n64_img.to_IA16()
+                palette, indexes = n64_img.to_CI8(workers=workers, palette=prev_palette, stats=quant_stats, quantizer=quantizer)
+            else:
+                data = getattr(n64_img, f'to_{output_fmt}')()
+
+            if quant_stats is not None and palette:
+                print(f'{quantizer} stats, stages: {", ".join(QUANTIZERS[quantizer].stats_stages)}')
+                print(quant_stats.report())
 
             tex_name, _ = os.path.splitext(os.path.split(img_path)[-1])
             tex_name = f'{tex_name}_{output_fmt}'
             tex_name = re.sub(' ', '_', tex_name)
             tex_name = re.sub('[^0-9a-zA-Z\_]+', '', tex_name)
-            file_data = ''
-            if palette:
-                pal_C = to_c_def(f'{tex_name}_pal', palette, U16)
-                idxs_C = to_c_def(f'{tex_name}_indexes', indexes, U8)
-                file_data = '\n'.join([pal_C, idxs_C])
+            c_defs = []
+            if compression:
+                arrays = [(tex_name, data)]
+                if palette:
+                    arrays = [(f'{tex_name}_pal', palette), (f'{tex_name}_indexes', indexes)]
+                for name, raw in arrays:
+                    comp, report = compress_asset(name, raw.data, compression, level)
+                    print(report)
+                    c_defs.append((
+                        f'{name}_{compression.lower()}',
+                        to_byte_list(U8, comp, fmt=True),
+                        U8))
+            elif palette:
+                c_defs.append((f'{tex_name}_pal', palette, U16))
+                c_defs.append((f'{tex_name}_indexes', indexes, U8))
             else:
-                file_data = to_c_def(tex_name, data, siz)
-            
+                c_defs.append((tex_name, data, siz))
+
+            if write_bin:
+                for name, arr, _ in c_defs:
+                    with open(f'{name}.bin', 'wb') as fp:
+                        arr.write_bin(fp)
+                    print(f'Success! Data written to {name}.bin')
+                exit(0)
+
             output_fn = (f'{tex_name}.inc.c')
             new_fn = input(f'Enter filename or press enter to use {output_fn}: ')
             if new_fn:
                 output_fn = new_fn
             with open(output_fn, 'w') as fp:
-                fp.write(file_data)
+                write_c_defs(fp, c_defs)
             print(f'Success! Data written to {output_fn}')
 
 if __name__ == "__main__":
@@ -0,0 +1,251 @@
+import sys, time
+from conv import *
+
+MIO0 = 'MIO0'
+YAY0 = 'YAY0'
+YAZ0 = 'YAZ0'
+COMPRESSIONS = [MIO0, YAY0, YAZ0]
+MAGIC = {
+    MIO0: b'MIO0',
+    YAY0: b'Yay0',
+    YAZ0: b'Yaz0'
+}
+
+WINDOW = 0x1000
+MIN_MATCH = 3
+# MIO0 has no length extension byte
+MAX_MATCH = {
+    MIO0: 0x12,
+    YAY0: 0x111,
+    YAZ0: 0x111
+}
+# Hash chain positions tried per byte for each level
+CHAIN_DEPTH = [0, 1, 2, 4, 8, 16, 32, 64, 256, WINDOW]
+LAZY_LEVEL = 6
+DEFAULT_LEVEL = 5
+
+u32 = lambda x: x.to_bytes(4, 'big')
+
+class MatchFinder(object):
+    # LZ77 hash chains over 3 byte prefixes inside the 4KB window
+    def __init__(self, data, max_len, level=DEFAULT_LEVEL):
+        self.data = bytes(data)
+        self.max_len = max_len
+        self.depth = CHAIN_DEPTH[max(1, min(level, len(CHAIN_DEPTH) - 1))]
+        self.head = {}
+        self.prev = [-1] * len(self.data)
+        self.inserted = 0
+
+    def insert_to(self, pos):
+        data, head, prev = self.data, self.head, self.prev
+        end = min(pos, len(data) - MIN_MATCH + 1)
+        for i in range(self.inserted, end):
+            key = data[i:i + MIN_MATCH]
+            prev[i] = head.get(key, -1)
+            head[key] = i
+        self.inserted = max(self.inserted, end)
+
+    def longest(self, pos):
+        data = self.data
+        self.insert_to(pos)
+        max_len = min(self.max_len, len(data) - pos)
+        if max_len < MIN_MATCH:
+            return (0, 0)
+
+        best_len, best_dist = 0, 0
+        cand = self.head.get(data[pos:pos + MIN_MATCH], -1)
+        tries = self.depth
+        while cand >= 0 and pos - cand <= WINDOW and tries > 0:
+            tries -= 1
+            if data[cand + best_len] == data[pos + best_len]:
+                n = MIN_MATCH
+                while n < max_len and data[cand + n] == data[pos + n]:
+                    n += 1
+                if n > best_len:
+                    best_len, best_dist = n, pos - cand
+                    if n == max_len:
+                        break
+            cand = self.prev[cand]
+        return (best_len, best_dist)
+
+    def tokens(self):
+        # Literal bytes as ints, matches as (length, distance)
+        pos = 0
+        lazy = self.depth >= CHAIN_DEPTH[LAZY_LEVEL]
+        match = self.longest(0)
+        while pos < len(self.data):
+            length, dist = match
+            if length >= MIN_MATCH and lazy and pos + 1 < len(self.data):
+                next_match = self.longest(pos + 1)
+                if next_match[0] > length:
+                    yield self.data[pos]
+                    pos += 1
+                    match = next_match
+                    continue
+            if length >= MIN_MATCH:
+                yield (length, dist)
+                pos += length
+            else:
+                yield self.data[pos]
+                pos += 1
+            match = self.longest(pos)
+
+def pack_bits(bits):
+    # MIO0/Yay0 layout bits are MSB first in big-endian u32 words
+    out = bytearray()
+    for word in chunks(32, bits):
+        val = 0
+        for i, bit in enumerate(word):
+            val |= bit << (31 - i)
+        out += u32(val)
+    return out
+
+def compress_mio0(data, level=DEFAULT_LEVEL, method=MIO0):
+    bits, links, chunk = [], bytearray(), bytearray()
+    for token in MatchFinder(data, MAX_MATCH[method], level).tokens():
+        if isinstance(token, int):
+            bits.append(1)
+            chunk.append(token)
+            continue
+        length, dist = token
+        bits.append(0)
+        if method == MIO0:
+            links += ((length - 3) << 12 | (dist - 1)).to_bytes(2, 'big')
+        elif length >= 0x12:
+            links += (dist - 1).to_bytes(2, 'big')
+            chunk.append(length - 0x12)
+        else:
+            links += ((length - 2) << 12 | (dist - 1)).to_bytes(2, 'big')
+
+    layout = pack_bits(bits)
+    links_offset = 0x10 + len(layout)
+    chunk_offset = links_offset + len(links)
+    header = MAGIC[method] + u32(len(data)) + u32(links_offset) + u32(chunk_offset)
+    return bytes(header + layout + links + chunk)
+
+def compress_yay0(data, level=DEFAULT_LEVEL):
+    return compress_mio0(data, level, method=YAY0)
+
+def compress_yaz0(data, level=DEFAULT_LEVEL):
+    out = bytearray(MAGIC[YAZ0] + u32(len(data)) + bytes(8))
+    tokens = MatchFinder(data, MAX_MATCH[YAZ0], level).tokens()
+    for group in chunks(8, tokens):
+        code = 0
+        body = bytearray()
+        for i, token in enumerate(group):
+            if isinstance(token, int):
+                code |= 0x80 >> i
+                body.append(token)
+                continue
+            length, dist = token
+            if length >= 0x12:
+                body += bytes([(dist - 1) >> 8, (dist - 1) & 0xFF, length - 0x12])
+            else:
+                body += bytes([(length - 2) << 4 | (dist - 1) >> 8, (dist - 1) & 0xFF])
+        out.append(code)
+        out += body
+    return bytes(out)
+
+def decompress_mio0(data):
+    method = MIO0 if data[:4] == MAGIC[MIO0] else YAY0
+    size = int.from_bytes(data[4:8], 'big')
+    links = int.from_bytes(data[8:12], 'big')
+    chunk = int.from_bytes(data[12:16], 'big')
+    layout = 0x10
+    out = bytearray()
+    bit = 0
+    while len(out) < size:
+        word = int.from_bytes(data[layout + (bit >> 5) * 4:layout + (bit >> 5) * 4 + 4], 'big')
+        is_literal = (word >> (31 - (bit & 31))) & 1
+        bit += 1
+        if is_literal:
+            out.append(data[chunk])
+            chunk += 1
+            continue
+        val = int.from_bytes(data[links:links + 2], 'big')
+        links += 2
+        start = len(out) - (val & 0xFFF) - 1
+        length = (val >> 12) + 3
+        if method == YAY0:
+            length = (val >> 12) + 2
+            if val >> 12 == 0:
+                length = data[chunk] + 0x12
+                chunk += 1
+        for i in range(length):
+            out.append(out[start + i])
+    return bytes(out)
+
+def decompress_yaz0(data):
+    size = int.from_bytes(data[4:8], 'big')
+    pos = 0x10
+    out = bytearray()
+    while len(out) < size:
+        code = data[pos]
+        pos += 1
+        for i in range(8):
+            if len(out) >= size:
+                break
+            if code & (0x80 >> i):
+                out.append(data[pos])
+                pos += 1
+                continue
+            b1, b2 = data[pos], data[pos + 1]
+            pos += 2
+            start = len(out) - (((b1 & 0xF) << 8) | b2) - 1
+            length = (b1 >> 4) + 2
+            if b1 >> 4 == 0:
+                length = data[pos] + 0x12
+                pos += 1
+            for j in range(length):
+                out.append(out[start + j])
+    return bytes(out)
+
+COMPRESSORS = {
+    MIO0: compress_mio0,
+    YAY0: compress_yay0,
+    YAZ0: compress_yaz0
+}
+
+def compress(data, method=YAY0, level=DEFAULT_LEVEL):
+    method = method.upper()
+    if method not in COMPRESSORS:
+        raise ValueError(f'Unknown compression {method}')
+    return COMPRESSORS[method](data, level)
+
+def decompress(data):
+    magic = bytes(data[:4])
+    if magic in [MAGIC[MIO0], MAGIC[YAY0]]:
+        return decompress_mio0(data)
+    if magic == MAGIC[YAZ0]:
+        return decompress_yaz0(data)
+    raise ValueError(f'Unknown compression header {magic}')
+
+def compress_asset(name, data, method=YAY0, level=DEFAULT_LEVEL):
+    # Compress one array and build its ratio/throughput report line
+    start = time.perf_counter()
+    out = compress(data, method, level)
+    elapsed = time.perf_counter() - start
+    ratio = len(out) / len(data) if data else 1.0
+    speed = len(data) / elapsed / 1024 if elapsed > 0 else 0.0
+    report = f'{name}: {len(data)} -> {len(out)} bytes ({ratio:.1%}) {method.upper()} level {level}, {speed:.1f} KB/s'
+    return (out, report)
+
+
+def main():
+    if len(sys.argv) < 3 or sys.argv[1].lower() in ['help', '-h', '--help']:
+        print('command <input path> <output path> [compression] [level]')
+        print('\nCompressions:')
+        print(', '.join(COMPRESSIONS))
+        exit(0)
+
+    method = sys.argv[3].upper() if len(sys.argv) > 3 else YAY0
+    level = int(sys.argv[4]) if len(sys.argv) > 4 else DEFAULT_LEVEL
+    with open(sys.argv[1], 'rb') as fp:
+        data = fp.read()
+    out, report = compress_asset(sys.argv[1], data, method, level)
+    with open(sys.argv[2], 'wb') as fp:
+        fp.write(out)
+    print(report)
+
+if __name__ == "__main__":
+    main()
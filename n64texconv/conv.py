@@ -1,8 +1,11 @@
-import mathutils
 import sys, os, re
 from PIL import Image
 from pprint import pprint
-from exoquant import ExoQuant
+from quantizers import DEFAULT_QUANTIZER, available_quantizers, get_quantizer
+try:
+    import mathutils
+except ImportError:
+    mathutils = None
 
 U8 = 1
 U16 = 2
@@ -13,18 +16,36 @@ RGBA32 = 'RGBA32'
 IA4 = 'IA4'
 IA8 = 'IA8'
 IA16 = 'IA16'
+I4 = 'I4'
+I8 = 'I8'
 CI4 = 'CI4'
 CI8 = 'CI8'
-FORMATS = [RGBA16, RGBA32, IA4, IA8, IA16, CI4, CI8]
+FORMATS = [RGBA16, RGBA32, IA4, IA8, IA16, I4, I8, CI4, CI8]
 SIZES = ['U8', 'U16', 'U32']
 SIZE_DEF = {
     '1': 'u8',
     '2': 'u16',
     '4': 'u32'
 }
+# Peak bytes per pixel of converting the whole image at once, of the
+# output that is still built whole in strip mode, and the quantizer's
+# hash table plus per pixel cost, measured with bench.py
+PIXEL_PEAK = 12
+OUTPUT_PEAK = 4
+QUANTIZE_BASE = 0xC4000
+QUANTIZE_PEAK = 8
+STRIP_ROWS = 16
+CHANNELS = {
+    'RGBA': 4,
+    'RGB': 3,
+    'LA': 2,
+    'L': 1
+}
 
 clamp32 = lambda x : (int(x) & 0x1F)
 scale5_8 = lambda x: (int((x * 0xFF) / 0x1F))
+# Smallest 8 bit value that to5551 maps to x
+seed5_8 = lambda x: (-(-x * 0xFF // 0x1F))
 packu8 = lambda vals: ((vals[0] << 4) | vals[1])
 u8 = lambda x : (x & 0xFF)
 
@@ -50,8 +71,57 @@ def bchunks(n, bytes_arr):
             items.append(0)
         yield items
 
+def lut(func):
+    # 256 entry byte table for bytes.translate
+    return bytes(func(i) & 0xFF for i in range(256))
+
+def interleave(*planes):
+    n = len(planes)
+    out = bytearray(len(planes[0]) * n)
+    for i, plane in enumerate(planes):
+        out[i::n] = plane
+    return out
+
+def bor(*planes):
+    # Bitwise OR of equal length byte strings as a single big int op
+    val = 0
+    for plane in planes:
+        val |= int.from_bytes(plane, 'big')
+    return val.to_bytes(len(planes[0]), 'big')
+
+def to_rgba_buffer(data, width, height, channels='RGBA'):
+    # Flat RGBA byte view of any buffer-protocol object.
+    # RGBA data is viewed in place, other layouts are expanded once.
+    if channels not in CHANNELS:
+        raise ValueError(f'Unsupported channel layout {channels}')
+    n_ch = CHANNELS[channels]
+    src = memoryview(data).cast('B')
+    n_pixels = width * height
+    if len(src) != n_pixels * n_ch:
+        raise ValueError(
+            f'Buffer holds {len(src)} bytes, '
+            f'expected {n_pixels * n_ch} for {width}x{height} {channels}')
+    if n_ch == 4:
+        return src
+
+    out = bytearray(n_pixels * 4)
+    if channels == 'RGB':
+        out[0::4] = src[0::3]
+        out[1::4] = src[1::3]
+        out[2::4] = src[2::3]
+    else:
+        # L and LA are gray, copy luminance into each color channel
+        for c in range(3):
+            out[c::4] = src[0::n_ch]
+    out[3::4] = src[1::2] if channels == 'LA' else b'\xFF' * n_pixels
+    return memoryview(out)
+
 def get_ia(color):
-    intensity = mathutils.Color(color[0:3]).v
+    # HSV value, which is the brightest color channel
+    if mathutils is None:
+        intensity = max(color[0:3])
+    else:
+        intensity = mathutils.Color(color[0:3]).v
     alpha = color[3] if len(color) > 3 else 1
     return (intensity, alpha)
 
@@ -84,6 +154,17 @@ def to5551(t, lst=False):
         return [r, g, b, a]
     return ((r << 11)) | (g << 6) | (b << 1) | a
 
+def unpack5551(val):
+    return [(val >> 11) & 0x1F, (val >> 6) & 0x1F, (val >> 1) & 0x1F, val & 1]
+
+def seed5551(t):
+    return [
+        seed5_8(t[0]),
+        seed5_8(t[1]),
+        seed5_8(t[2]),
+        0 if t[3] == 0 else 255
+    ]
+
 def un5551(t):
     return [
         scale5_8(t[0]),
@@ -95,122 +176,346 @@ def un5551(t):
 def to8888(t):
     return (u8(t[0]) << 24) | (u8(t[1]) << 16) | (u8(t[2]) << 8) | u8(t[3])
 
-def to_byte_list(siz, img_data, fmt=False):
-    arr = [c for c in bchunks(siz, bytes(img_data))]
-    if fmt:
-        int_arr = [int.from_bytes(c, 'big') for c in arr]
-        if siz is U8:
-            return [f'{b:#04X}' for b in int_arr]
-        if siz is U16:
-            return [f'{b:#06X}' for b in int_arr]
-        if siz is U32:
-            return [f'{b:#010X}' for b in int_arr]
-    return arr
-
-def to_byte_list_dec(func):
-    def wrapper(self, *args, **kwargs):
+def parse_size(size):
+    # '512K', '64M', '1G' or plain bytes
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+    size = size.strip().upper().rstrip('B')
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+def estimate_peak(fmt, width, height, strips=False):
+    # Rough peak memory of converting all rows at once, or a strip of
+    # rows at a time. The CI quantizer's memory is the same either way.
+    n = width * height
+    if strips:
+        peak = width * min(height, STRIP_ROWS) * PIXEL_PEAK + n * OUTPUT_PEAK
+    else:
+        peak = n * PIXEL_PEAK
+    if fmt in [CI4, CI8]:
+        peak += QUANTIZE_BASE + n * QUANTIZE_PEAK
+    return int(peak)
+
+class TexData(object):
+    # Encoder output, one contiguous big-endian buffer padded to whole
+    # elements. C text, hex and .bin are rendered from it on demand,
+    # iterating gives the hex strings (fmt) or element bytes that
+    # the old byte lists held.
+    def __init__(self, siz, data, fmt=True, tex_fmt=None, width=None, height=None):
+        data = bytes(data)
+        self.data = data + bytes(-len(data) % siz)
+        self.siz = siz
+        self.fmt = fmt
+        self.tex_fmt = tex_fmt
+        self.width = width
+        self.height = height
+
+    def __len__(self):
+        return len(self.data) // self.siz
+
+    def __bytes__(self):
+        return self.data
+
+    def __iter__(self):
         siz = self.siz
-        fmt = bool(kwargs.get('fmt', True))
-        return to_byte_list(
-            siz,
+        for i in range(0, len(self.data), siz):
+            chunk = self.data[i:i + siz]
+            yield f'0X{chunk.hex().upper()}' if self.fmt else chunk
+
+    def view(self):
+        return memoryview(self.data)
+
+    def as_size(self, siz):
+        # Same bytes split into another element size
+        if siz == self.siz:
+            return self
+        return TexData(siz, self.data, self.fmt, self.tex_fmt, self.width, self.height)
+
+    def hex(self):
+        return self.data.hex().upper()
+
+    def hex_lines(self, per_line=16):
+        # Comma separated C hex values, per_line bytes at a time
+        digits = self.siz * 2
+        for i in range(0, len(self.data), per_line):
+            line = self.data[i:i + per_line].hex().upper()
+            yield ', '.join(f'0X{line[j:j + digits]}' for j in range(0, len(line), digits))
+
+    def to_c_def(self, var):
+        return to_c_def(var, self, self.siz)
+
+    def write_bin(self, fp):
+        fp.write(self.data)
+
+# Per channel tables giving the same results as to5551/un5551/get_ia*_val
+# for a whole plane of bytes at once through bytes.translate
+ENC_R5_HI = lut(lambda c: clamp32((c / 255) * 31) << 3)
+ENC_G5_HI = lut(lambda c: clamp32((c / 255) * 31) >> 2)
+ENC_G5_LO = lut(lambda c: (clamp32((c / 255) * 31) & 0x3) << 6)
+ENC_B5_LO = lut(lambda c: clamp32((c / 255) * 31) << 1)
+ENC_A1_LO = lut(lambda c: 1 if c == 255 else 0)
+ENC_C5_8 = lut(lambda c: scale5_8(clamp32((c / 255) * 31)))
+ENC_A1_8 = lut(lambda c: 255 if c == 255 else 0)
+ENC_I3_IA4 = lut(lambda i: (int(i * 0x7) & 0x7) << 1)
+ENC_A1_IA4 = lut(lambda a: 1 if a > 0.5 else 0)
+ENC_I4_IA8 = lut(lambda i: (int(i * 0xF) & 0xF) << 4)
+ENC_A4_IA8 = lut(lambda a: int(a * 0xF) & 0xF)
+ENC_I4_I4 = lut(lambda i: i >> 4)
+ENC_NIBBLE_HI = lut(lambda x: x << 4)
+
+def planes(pixels):
+    # Split flat RGBA pixels into one bytes object per channel
+    px = bytes(pixels)
+    return (px[0::4], px[1::4], px[2::4], px[3::4])
+
+def intensity(r, g, b):
+    return bytes(map(max, r, g, b))
+
+def rows_RGBA16(pixels):
+    r, g, b, a = planes(pixels)
+    return interleave(
+        bor(r.translate(ENC_R5_HI), g.translate(ENC_G5_HI)),
+        bor(g.translate(ENC_G5_LO), b.translate(ENC_B5_LO), a.translate(ENC_A1_LO)))
+
+def pack_nibbles(nibbles):
+    # Same packing as pack_ia4, 2 texels per byte
+    if len(nibbles) % 2:
+        nibbles += b'\x00'
+    return bor(nibbles[0::2].translate(ENC_NIBBLE_HI), nibbles[1::2])
+
+def rows_IA4(pixels):
+    r, g, b, a = planes(pixels)
+    return pack_nibbles(bor(intensity(r, g, b).translate(ENC_I3_IA4), a.translate(ENC_A1_IA4)))
+
+def rows_IA8(pixels):
+    r, g, b, a = planes(pixels)
+    return bor(intensity(r, g, b).translate(ENC_I4_IA8), a.translate(ENC_A4_IA8))
+
+def rows_IA16(pixels):
+    r, g, b, a = planes(pixels)
+    return interleave(intensity(r, g, b), a)
+
+def rows_I4(pixels):
+    r, g, b, _ = planes(pixels)
+    return pack_nibbles(intensity(r, g, b).translate(ENC_I4_I4))
+
+def rows_I8(pixels):
+    r, g, b, _ = planes(pixels)
+    return intensity(r, g, b)
+
+def rows_CI_source(pixels):
+    r, g, b, a = planes(pixels)
+    return interleave(r.translate(ENC_C5_8), g.translate(ENC_C5_8), b.translate(ENC_C5_8), a.translate(ENC_A1_8))
+
+def to_byte_list(siz, img_data, fmt=False, **kwargs):
+    # kwargs: tex_fmt, width and height of the TexData
+    return TexData(siz, img_data, fmt=fmt, **kwargs)
+
+def palette_to_5551(rgba32_palette):
+    # Convert the palette colors back to RGBA16
+    return [
+        to5551([v[0], v[1], v[2], int(v[3])])
+        for v in chunks(4, rgba32_palette)]
+
+def palette_to_byte_list(rgba32_palette, fmt=False):
+    # The palette is an RGBA16 TLUT, one row of colors
+    pal = palette_to_5551(rgba32_palette)
+    return to_byte_list(
+        U16,
+        b''.join(val.to_bytes(2, 'big') for val in pal),
+        fmt=fmt,
+        tex_fmt=RGBA16,
+        width=len(pal),
+        height=1
+    )
+
+def palette_from_5551(pal_data):
+    # RGBA32 palette from big-endian RGBA16 palette bytes, picking
+    # the colors that to5551 turns back into the same values
+    pal_data = bytes(pal_data)
+    return [
+        v
+        for i in range(0, len(pal_data) - 1, 2)
+        for v in seed5551(unpack5551(int.from_bytes(pal_data[i:i + 2], 'big')))
+    ]
+
+def index_to_byte_list(col_depth, index_data, fmt=False, width=None, height=None):
+    # CI4 indexes are 2 indexes per byte
+    index_data = bytes(index_data)
+    if col_depth != 0x100:
+        index_data = pack_nibbles(index_data)
+    return to_byte_list(
+        U8,
+        index_data,
+        fmt=fmt,
+        tex_fmt=CI8 if col_depth == 0x100 else CI4,
+        width=width,
+        height=height)
+
+def tex_data_dec(func):
+    # Encoders return texel bytes, wrapped into a TexData
+    tex_fmt = func.__name__[len('to_'):]
+    def wrapper(self, *args, **kwargs):
+        return TexData(
+            self.siz,
             func(self, *args, **kwargs),
-            fmt=fmt)
+            fmt=bool(kwargs.get('fmt', True)),
+            tex_fmt=tex_fmt,
+            width=self.width,
+            height=self.height)
     return wrapper
 
 
 class N64Texture(object):
     siz = None
-    def __init__(self, img, siz=U16):
-        self._img = img
+    mem_budget = None
+    def __init__(self, img, siz=U16, mem_budget=None):
+        # Every PIL mode is normalized to RGBA up front so
+        # the encoders only ever see 4 channel pixels
+        if img.mode != 'RGBA':
+            img = img.convert('RGBA')
+        self.width, self.height = img.size
+        self._pixels = memoryview(img.tobytes())
         self.siz = siz
+        self.mem_budget = mem_budget
+
+    @classmethod
+    def from_buffer(cls, data, width, height, channels='RGBA', siz=U16, mem_budget=None):
+        # Build a texture from raw pixel data (bytes, bytearray,
+        # memoryview, NumPy array...) without going through PIL
+        tex = cls.__new__(cls)
+        tex.width = width
+        tex.height = height
+        tex._pixels = to_rgba_buffer(data, width, height, channels)
+        tex.siz = siz
+        tex.mem_budget = mem_budget
+        return tex
+
+    def low_mem(self, fmt):
+        # With a memory budget set, conversions that would not fit it
+        # are converted a strip of rows at a time
+        if self.mem_budget is None:
+            return False
+        return estimate_peak(fmt, self.width, self.height) > self.mem_budget
+
+    def min_peak(self, fmt):
+        # Estimated peak in strip mode, as low as a budget can get it
+        return estimate_peak(fmt, self.width, self.height, strips=True)
+
+    def iter_strips(self, fmt):
+        # Whole image at once, or strips of an even number of rows
+        # in low memory mode so IA4/CI4 pairs never straddle strips
+        rows = self.height
+        if self.low_mem(fmt):
+            rows = STRIP_ROWS
+        stride = self.width * 4
+        for y in range(0, self.height, rows):
+            yield self._pixels[y * stride:(y + rows) * stride]
+
+    def convert_rows(self, fmt, func):
+        # Run a table based row converter over the texture
+        out = bytearray()
+        for strip in self.iter_strips(fmt):
+            out += func(strip)
+        return out
 
     def iter_tex(self, func=None):
-        width, height = self._img.size
-        for y in range(height):
-            for x in range(width):
-                pixel = self._img.getpixel((x, y))
-                yield func(pixel) if func else pixel
+        px = self._pixels
+        pixels = zip(px[0::4], px[1::4], px[2::4], px[3::4])
+        if func is None:
+            return pixels
+        return map(func, pixels)
 
-    @to_byte_list_dec
+    @tex_data_dec
     def to_RGBA16(self, fmt=True):
-        return [
-            val
-            for vals in self.iter_tex(to5551)
-            for val in [vals >> 8, vals & 0xFF]
-        ]
+        return self.convert_rows(RGBA16, rows_RGBA16)
 
-    @to_byte_list_dec
+    @tex_data_dec
     def to_RGBA32(self, fmt=True):
-        return [
-            val
-            for vals in self.iter_tex()
-            for val in vals
-        ]
+        return self._pixels
     
-    @to_byte_list_dec
+    @tex_data_dec
     def to_IA4(self, fmt=True):
-        return [val for val in pack_ia4(chunks(2, self.iter_tex(get_ia4_val)))]
+        return self.convert_rows(IA4, rows_IA4)
     
-    @to_byte_list_dec
+    @tex_data_dec
     def to_IA8(self, fmt=True):
-        return [val for val in self.iter_tex(get_ia8_val)]
+        return self.convert_rows(IA8, rows_IA8)
     
-    @to_byte_list_dec
+    @tex_data_dec
     def to_IA16(self, fmt=True):
-        return [
-            val
-            for vals in self.iter_tex(get_ia16_val)
-            for val in vals
-        ]
+        return self.convert_rows(IA16, rows_IA16)
+
+    @tex_data_dec
+    def to_I4(self, fmt=True):
+        return self.convert_rows(I4, rows_I4)
 
-    def to_CI(self, col_depth, mode=RGBA16):
+    @tex_data_dec
+    def to_I8(self, fmt=True):
+        return self.convert_rows(I8, rows_I8)
+
+    def ci_source(self):
         # Compress colors to RGBA16 for a more accurate palette result
-        img_data = bytearray([
-            v for vals in self.iter_tex()
-            for v in un5551(to5551(vals, lst=True))
-        ])
-
-        exq = ExoQuant()
-        exq.feed(img_data)
-        exq.quantize(col_depth)
-        rgba32_palette = exq.get_palette(col_depth)
-
-        width, height = self._img.size
-        index_data = exq.map_image_ordered(width, height, img_data)
-
-        # Convert the palette colors back to RGBA16
-        pal_5551 = [
-            to5551([v[0], v[1], v[2], int(v[3])])
-            for v in chunks(4, rgba32_palette)]
-
-        pal = to_byte_list(
-            U16,
-            [   
-                val
-                for vals in pal_5551
-                for val in [vals >> 8, vals & 0xFF]
-            ],
-            fmt=True
-        )
-        # CI4 indexes are 2 indexes per byte
-        index_data = index_data if col_depth == 0x100 else [packu8(c) for c in chunks(2, index_data)]
-        idxs = to_byte_list(U8, index_data, fmt=True)
-        return (pal, idxs)
+        return self.convert_rows(CI8, rows_CI_source)
+
+    def to_CI(self, col_depth, mode=RGBA16, fmt=True, workers=None, palette=None, stats=None, quantizer=DEFAULT_QUANTIZER):
+        # palette: the texture's previous RGBA16 palette bytes, to
+        # refine it instead of quantizing from scratch
+        # stats: an ExqStats to fill with the quantizer's counters
+        # quantizer: name of a registered quantizer, see quantizers.py
+        if palette is not None and len(palette) != col_depth * 2:
+            raise ValueError(f'Previous palette has {len(palette) // 2} colors, {col_depth} needed')
+        img_data = self.ci_source()
+
+        quant = get_quantizer(quantizer, workers=workers, stats=stats)
+        quant.feed(img_data)
+        quant.quantize(col_depth, palette=None if palette is None else palette_from_5551(palette))
+        rgba32_palette = quant.palette(col_depth)
+
+        index_data = quant.map(self.width, self.height, img_data)
+        if max(index_data, default=0) >= col_depth:
+            raise ValueError(f'Quantizer {quantizer} returned an index past {col_depth} colors')
+        return (
+            palette_to_byte_list(rgba32_palette, fmt=fmt),
+            index_to_byte_list(col_depth, index_data, fmt=fmt, width=self.width, height=self.height))
     
-    def to_CI4(self, mode=RGBA16):
-        return self.to_CI(0x10, mode=mode)
+    def to_CI4(self, mode=RGBA16, **kwargs):
+        return self.to_CI(0x10, mode=mode, **kwargs)
 
-    def to_CI8(self, mode=RGBA16):
-        return self.to_CI(0x100, mode=mode)
+    def to_CI8(self, mode=RGBA16, **kwargs):
+        return self.to_CI(0x100, mode=mode, **kwargs)
 
 
-def to_c_def(var, data, size):
+def parse_opts(argv):
+    # Split --key=value options from positional arguments
+    args = [a for a in argv if not a.startswith('--')]
+    opts = dict(
+        a[2:].split('=', 1) if '=' in a else (a[2:], '')
+        for a in argv if a.startswith('--'))
+    return (args, opts)
+
+def c_def_lines(var, data, size):
+    # data: a TexData or a list of hex strings
     per_line = 16 / size
-    lines = []
-    lines.append(f'// size = {len(data)}')
-    lines.append(f'{SIZE_DEF[str(size)]} {var}[] = {"{"}')
-    for vals in chunks(per_line, data):
-        vals_str = ', '.join(vals)
-        lines.append(f'\t{vals_str},')
-    lines.append('};\n')
-    return '\n'.join(lines)
+    if isinstance(data, TexData):
+        data = data.as_size(size)
+        lines = data.hex_lines()
+    else:
+        lines = (', '.join(vals) for vals in chunks(per_line, data))
+    yield f'// size = {len(data)}'
+    yield f'{SIZE_DEF[str(size)]} {var}[] = {"{"}'
+    for vals_str in lines:
+        yield f'\t{vals_str},'
+    yield '};\n'
+
+def to_c_def(var, data, size):
+    return '\n'.join(c_def_lines(var, data, size))
+
+def write_c_defs(fp, c_defs):
+    # Stream (var, data, size) arrays to a file, same text as
+    # joining their to_c_def output with newlines
+    for i, (var, data, size) in enumerate(c_defs):
+        if i > 0:
+            fp.write('\n')
+        for j, line in enumerate(c_def_lines(var, data, size)):
+            fp.write(f'\n{line}' if j > 0 else line)
@@ -0,0 +1,170 @@
+import sys, os, re
+from conv import *
+
+C_TYPES = {
+    'u8': U8,
+    'u16': U16,
+    'u32': U32
+}
+C_DEF_RE = re.compile(r'\b(u8|u16|u32)\s+(\w+)\[\]\s*=\s*\{(.*?)\};', re.S)
+HEX_RE = re.compile(r'0[xX]([0-9a-fA-F]+)')
+
+NIBBLE_HI = lut(lambda x: x >> 4)
+NIBBLE_LO = lut(lambda x: x & 0xF)
+SCALE5_8 = lut(lambda x: scale5_8(x & 0x1F))
+SCALE4_8 = lut(lambda x: (x & 0xF) * 0x11)
+SCALE3_8 = lut(lambda x: ((x & 0x7) * 0xFF) // 0x7)
+
+# RGBA5551, split across the high and low byte of each texel
+R5_HI = lut(lambda x: x >> 3)
+G5_HI = lut(lambda x: (x & 0x7) << 2)
+G5_LO = lut(lambda x: x >> 6)
+B5_LO = lut(lambda x: (x >> 1) & 0x1F)
+A1_LO = lut(lambda x: 0xFF if x & 1 else 0)
+
+# IA8 is I4 A4, IA4 is I3 A1
+I4_IA8 = lut(lambda x: (x >> 4) * 0x11)
+A4_IA8 = lut(lambda x: (x & 0xF) * 0x11)
+I3_IA4 = lut(lambda x: (((x >> 1) & 0x7) * 0xFF) // 0x7)
+A1_IA4 = lut(lambda x: 0xFF if x & 1 else 0)
+
+
+def parse_c_defs(text):
+    # Arrays written by to_c_def, as big-endian bytes keyed by name
+    defs = {}
+    for ctype, name, body in C_DEF_RE.findall(text):
+        width = C_TYPES[ctype] * 2
+        digits = ''.join(v.zfill(width)[-width:] for v in HEX_RE.findall(body))
+        defs[name] = bytes.fromhex(digits)
+    return defs
+
+def unpack_nibbles(data, n):
+    data = bytes(data)
+    return bytes(interleave(data.translate(NIBBLE_HI), data.translate(NIBBLE_LO))[:n])
+
+def texel_bytes(data, n, siz):
+    data = bytes(data)
+    if len(data) < n * siz:
+        raise ValueError(f'Expected {n * siz} bytes of texel data, got {len(data)}')
+    return data[:n * siz]
+
+def decode_RGBA16(data, n):
+    data = texel_bytes(data, n, 2)
+    hi, lo = data[0::2], data[1::2]
+    r = hi.translate(R5_HI).translate(SCALE5_8)
+    g = bor(hi.translate(G5_HI), lo.translate(G5_LO)).translate(SCALE5_8)
+    b = lo.translate(B5_LO).translate(SCALE5_8)
+    a = lo.translate(A1_LO)
+    return interleave(r, g, b, a)
+
+def decode_RGBA32(data, n):
+    return bytearray(texel_bytes(data, n, 4))
+
+def decode_IA16(data, n):
+    data = texel_bytes(data, n, 2)
+    i = data[0::2]
+    return interleave(i, i, i, data[1::2])
+
+def decode_IA8(data, n):
+    data = texel_bytes(data, n, 1)
+    i = data.translate(I4_IA8)
+    return interleave(i, i, i, data.translate(A4_IA8))
+
+def decode_IA4(data, n):
+    nibbles = unpack_nibbles(texel_bytes(data, (n + 1) // 2, 1), n)
+    i = nibbles.translate(I3_IA4)
+    return interleave(i, i, i, nibbles.translate(A1_IA4))
+
+# I texels also stand in for alpha on the RDP
+def decode_I8(data, n):
+    i = texel_bytes(data, n, 1)
+    return interleave(i, i, i, i)
+
+def decode_I4(data, n):
+    i = unpack_nibbles(texel_bytes(data, (n + 1) // 2, 1), n).translate(SCALE4_8)
+    return interleave(i, i, i, i)
+
+def decode_CI(indexes, palette):
+    # One translate per channel does the palette lookup for every texel
+    n_colors = len(palette) // 2
+    pal = decode_RGBA16(palette, n_colors)
+    tables = [bytes(pal[c::4]).ljust(0x100, b'\x00') for c in range(4)]
+    return interleave(*[indexes.translate(t) for t in tables])
+
+def decode_CI8(data, n, palette):
+    return decode_CI(texel_bytes(data, n, 1), palette)
+
+def decode_CI4(data, n, palette):
+    return decode_CI(unpack_nibbles(texel_bytes(data, (n + 1) // 2, 1), n), palette)
+
+DECODERS = {
+    RGBA16: decode_RGBA16,
+    RGBA32: decode_RGBA32,
+    IA4: decode_IA4,
+    IA8: decode_IA8,
+    IA16: decode_IA16,
+    I4: decode_I4,
+    I8: decode_I8,
+    CI4: decode_CI4,
+    CI8: decode_CI8
+}
+
+def decode(fmt, data, width, height, palette=None):
+    # Decode N64 texel data back to a flat RGBA32 bytearray
+    if fmt not in DECODERS:
+        raise ValueError(f'Unknown format {fmt}')
+    n = width * height
+    if fmt in [CI4, CI8]:
+        if palette is None:
+            raise ValueError(f'{fmt} data needs a palette')
+        return DECODERS[fmt](data, n, palette)
+    return DECODERS[fmt](data, n)
+
+def decode_c_defs(text, fmt, width, height):
+    # Decode the texture in a file written by the cli
+    defs = parse_c_defs(text)
+    if fmt in [CI4, CI8]:
+        pal = [name for name in defs if name.endswith('_pal')]
+        idxs = [name for name in defs if name.endswith('_indexes')]
+        if not pal or not idxs:
+            raise ValueError(f'No palette and index arrays found for {fmt}')
+        return decode(fmt, defs[idxs[0]], width, height, palette=defs[pal[0]])
+    if not defs:
+        raise ValueError('No arrays found')
+    return decode(fmt, next(iter(defs.values())), width, height)
+
+def to_image(rgba, width, height):
+    return Image.frombytes('RGBA', (width, height), bytes(rgba))
+
+
+def main():
+    if len(sys.argv) < 6 or sys.argv[1].lower() in ['help', '-h', '--help']:
+        print('command <.inc.c or .bin path> <format> <width> <height> <output png> [palette .bin]')
+        print('\nFormats:')
+        print(', '.join(FORMATS))
+        exit(0)
+
+    data_path, fmt = sys.argv[1], sys.argv[2].upper()
+    width, height = int(sys.argv[3]), int(sys.argv[4])
+    if fmt not in FORMATS:
+        print(f'Choose from the following formats:')
+        print(', '.join(FORMATS))
+        exit(1)
+
+    if data_path.endswith('.c'):
+        with open(data_path, 'r') as fp:
+            rgba = decode_c_defs(fp.read(), fmt, width, height)
+    else:
+        with open(data_path, 'rb') as fp:
+            data = fp.read()
+        palette = None
+        if len(sys.argv) > 6:
+            with open(sys.argv[6], 'rb') as fp:
+                palette = fp.read()
+        rgba = decode(fmt, data, width, height, palette=palette)
+
+    to_image(rgba, width, height).save(sys.argv[5])
+    print(f'Success! Image written to {sys.argv[5]}')
+
+if __name__ == "__main__":
+    main()
@@ -34,6 +34,16 @@
 #* indexData = exq.map_image_ordered(<width>, <height>, <byte array of rgba32 data>)
 #* // map image to palette
 #*
+#* To refine a previous palette instead of quantizing from scratch:
+#* exq.quantize_from_palette(<rgba32 palette>, <num of colors>)
+#*
+#* To map with worker processes, same indexes as map_image_ordered:
+#* indexData = exq.map_image_parallel(<width>, <height>, <byte array of rgba32 data>, <num of workers>)
+#*
+#* To collect hash, search and cache counters:
+#* exq.enable_stats() // before feeding
+#* print(exq.get_stats().report())
+#*
 #* Notes:
 #* ------
 #*
@@ -48,6 +58,10 @@
 
 import math
 import random
+import sys
+from array import array
+from collections import Counter
+from multiprocessing import Pool, shared_memory
 
 _EXQ_HASH_BITS = 16
 _EXQ_HASH_SIZE = 1 << _EXQ_HASH_BITS
@@ -57,6 +71,8 @@ _EXQ_SCALE_B = 0.8
 _EXQ_SCALE_A = 1.0
 
 class ExqColor:
+    __slots__ = ('r', 'g', 'b', 'a')
+
     def __init__(self):
         self.r = 0.0
         self.g = 0.0
@@ -64,6 +80,9 @@ class ExqColor:
         self.a = 0.0
 
 class ExqHistogramEntry:
+    __slots__ = ('color', 'ored', 'ogreen', 'oblue', 'oalpha', 'palIndex',
+                 'ditherScale', 'ditherIndex', 'num', 'pNext', 'pNextInHash')
+
     def __init__(self):
         self.color = ExqColor()
         self.ored = 0 # byte
@@ -78,6 +97,8 @@ class ExqHistogramEntry:
         self.pNextInHash = None # ExqHistogramEntry
 
 class ExqNode:
+    __slots__ = ('dir', 'avg', 'vdif', 'err', 'num', 'pHistogram', 'pSplit')
+
     def __init__(self):
         self.dir = ExqColor() # ExqColor
         self.avg = ExqColor() # ExqColor
@@ -96,10 +117,158 @@ class ExqData:
         self.optimized = False # bool
         self.transparency = False # bool
 
+class ExqHistogram:
+    # Pixel count per unique rgba32 color in first seen order. Histograms
+    # of consecutive strips (or separate images) merged in order feed
+    # ExoQuant exactly like one serial feed of all the pixel data.
+    def __init__(self, pData=None):
+        self.counts = Counter()
+        if pData is not None:
+            self.add(pData)
+
+    def add(self, pData):
+        nPixels = len(pData) // 4
+        view = memoryview(pData).cast('B')[:nPixels * 4]
+        if sys.byteorder == 'little':
+            pixels = view.cast('I')
+        else:
+            pixels = array('I', view.tobytes())
+            pixels.byteswap()
+        # Each key is the same r | g << 8 | b << 16 | a << 24 as to_rgba
+        self.counts.update(pixels)
+        return self
+
+    def merge(self, other):
+        self.counts.update(other.counts)
+        return self
+
+    @classmethod
+    def merged(cls, hists):
+        out = cls()
+        for hist in hists:
+            out.merge(hist)
+        return out
+
+    @property
+    def num_pixels(self):
+        return sum(self.counts.values())
+
+class ExqStats:
+    # Opt-in counters of hash, search and cache behavior, filled in by
+    # an ExoQuant after enable_stats(). Stages are feed, quantize,
+    # optimize and map.
+    def __init__(self):
+        self.stage = 'feed'
+        self.hashLookups = 0
+        self.hashProbes = 0
+        self.nearestCalls = Counter()
+        self.cacheHits = Counter()
+        self.cacheMisses = Counter()
+        self.sortCalls = 0
+        self.sortMaxDepth = 0
+        self.numEntries = 0
+        self.bucketsUsed = 0
+        self.chainLengths = Counter()
+
+    def count_cache(self, name, hit):
+        if hit:
+            self.cacheHits[name] += 1
+        else:
+            self.cacheMisses[name] += 1
+
+    def collect_hash(self, pHash):
+        # Bucket occupancy and chain length histogram of the color hash
+        self.chainLengths = Counter()
+        for pCur in pHash:
+            n = 0
+            while pCur != None:
+                n += 1
+                pCur = pCur.pNextInHash
+            if n > 0:
+                self.chainLengths[n] += 1
+        self.bucketsUsed = sum(self.chainLengths.values())
+        self.numEntries = sum(n * k for n, k in self.chainLengths.items())
+
+    def hit_rate(self, name):
+        total = self.cacheHits[name] + self.cacheMisses[name]
+        return self.cacheHits[name] / total if total else 0.0
+
+    def as_dict(self):
+        return {
+            'entries': self.numEntries,
+            'bucketsUsed': self.bucketsUsed,
+            'bucketOccupancy': self.bucketsUsed / _EXQ_HASH_SIZE,
+            'chainLengths': dict(sorted(self.chainLengths.items())),
+            'maxChain': max(self.chainLengths, default=0),
+            'hashLookups': self.hashLookups,
+            'hashProbes': self.hashProbes,
+            'probesPerLookup': self.hashProbes / self.hashLookups if self.hashLookups else 0.0,
+            'nearestCalls': dict(self.nearestCalls),
+            'cacheHitRates': {
+                name: self.hit_rate(name)
+                for name in sorted(set(self.cacheHits) | set(self.cacheMisses))
+            },
+            'sortCalls': self.sortCalls,
+            'sortMaxDepth': self.sortMaxDepth
+        }
+
+    def report(self):
+        stats = self.as_dict()
+        lines = [
+            f'hash: {stats["entries"]} colors in {stats["bucketsUsed"]} buckets '
+            f'({stats["bucketOccupancy"]:.1%} occupied), max chain {stats["maxChain"]}',
+            '  chain lengths: ' + ', '.join(f'{n}: {k}' for n, k in stats['chainLengths'].items()),
+            f'  {stats["hashLookups"]} lookups, {stats["probesPerLookup"]:.2f} probes per lookup',
+            'nearest color calls: ' + ', '.join(f'{k} {v}' for k, v in stats['nearestCalls'].items()),
+            'cache hit rates: ' + ', '.join(f'{k} {v:.1%}' for k, v in stats['cacheHitRates'].items()),
+            f'sort: {stats["sortCalls"]} calls, max recursion depth {stats["sortMaxDepth"]}'
+        ]
+        return '\n'.join(lines)
+
+def build_histogram(pData, workers=None, strips=None):
+    # Build the histogram of pData over strips in worker processes
+    nPixels = len(pData) // 4
+    strips = strips or workers or 1
+    step = max(1, -(-nPixels // strips)) * 4
+    data = bytes(pData)
+    parts = [data[i:i + step] for i in range(0, nPixels * 4, step)]
+    if len(parts) < 2:
+        return ExqHistogram(data)
+    with Pool(workers) as pool:
+        return ExqHistogram.merged(pool.map(ExqHistogram, parts))
+
+# Shared buffers and palette of a map_image_parallel worker
+_mapShared = None
+
+def init_map_worker(srcName, outName, width, avg, transparency):
+    global _mapShared
+    _mapShared = (
+        shared_memory.SharedMemory(name=srcName),
+        shared_memory.SharedMemory(name=outName),
+        width, avg, transparency)
+
+def map_strip(rows):
+    # Map rows y0..y1 of the shared source into the shared indexes with
+    # a palette only ExoQuant, caching through the strip's own histogram
+    src, out, width, avg, transparency = _mapShared
+    y0, y1 = rows
+    exq = ExoQuant()
+    if not transparency:
+        exq.no_transparency()
+    exq.pExq.numColors = len(avg)
+    for node, (r, g, b, a) in zip(exq.pExq.node, avg):
+        node.avg.r, node.avg.g, node.avg.b, node.avg.a = r, g, b, a
+    exq.pExq.optimized = True
+    pIn = bytes(src.buf[y0 * width * 4:y1 * width * 4])
+    exq.feed(pIn)
+    out.buf[y0 * width:y1 * width] = exq.map_image_dither(width, y1 - y0, pIn, True)
+
 class ExoQuant:
     def __init__(self):
         self.sortDir = ExqColor()
         self.pExq = ExqData()
+        self.seed = None
+        self.stats = None
         
         for i in range(256):
             self.pExq.node[i] = ExqNode()
@@ -112,6 +281,23 @@ class ExoQuant:
         self.pExq.transparency = True
         self.pExq.numBitsPerChannel = 8
     
+    def enable_stats(self, stats=None):
+        self.stats = stats or ExqStats()
+        return self.stats
+
+    def get_stats(self):
+        if self.stats is not None:
+            self.stats.collect_hash(self.pExq.pHash)
+        return self.stats
+
+    def set_stage(self, stage):
+        # Returns the previous stage so nested calls can restore it
+        if self.stats is None:
+            return None
+        prev = self.stats.stage
+        self.stats.stage = stage
+        return prev
+
     def no_transparency(self):
         self.pExq.transparency = False
     
@@ -132,22 +318,30 @@ class ExoQuant:
         return r | (g << 8) | (b << 16) | (a << 24)
         
     def feed(self, pData):
+        self.feed_histogram(ExqHistogram(pData))
+
+    def feed_histogram(self, hist):
         channelMask = 0xFF00 >> self.pExq.numBitsPerChannel
-        nPixels = len(pData) // 4
-        
-        for i in range(nPixels):
-            r = pData[i * 4 + 0]
-            g = pData[i * 4 + 1] 
-            b = pData[i * 4 + 2]
-            a = pData[i * 4 + 3]
-            hash = self.make_hash(self.to_rgba(r, g, b, a))
+        stats = self.stats
+        self.set_stage('feed')
+
+        for rgba, num in hist.counts.items():
+            r = rgba & 0xFF
+            g = (rgba >> 8) & 0xFF
+            b = (rgba >> 16) & 0xFF
+            a = rgba >> 24
+            hash = self.make_hash(rgba)
             pCur = self.pExq.pHash[hash]
 
             while (pCur != None and (pCur.ored != r or pCur.ogreen != g or pCur.oblue != b or pCur.oalpha != a)):
                 pCur = pCur.pNextInHash
+                if stats is not None:
+                    stats.hashProbes += 1
+            if stats is not None:
+                stats.hashLookups += 1
 
             if (pCur != None):
-                pCur.num += 1
+                pCur.num += num
             else:
                 pCur = ExqHistogramEntry()
                 pCur.pNextInHash = self.pExq.pHash[hash]
@@ -167,7 +361,7 @@ class ExoQuant:
                     pCur.color.r *= pCur.color.a
                     pCur.color.g *= pCur.color.a
                     pCur.color.b *= pCur.color.a
-                pCur.num = 1
+                pCur.num = num
                 pCur.palIndex = -1
                 pCur.ditherScale.r = pCur.ditherScale.g = pCur.ditherScale.b = pCur.ditherScale.a = -1
                 pCur.ditherIndex[0] = pCur.ditherIndex[1] = pCur.ditherIndex[2] = pCur.ditherIndex[3] = -1
@@ -185,6 +379,7 @@ class ExoQuant:
         if (nColors > 256):
             nColors = 256
 
+        prevStage = self.set_stage('quantize')
         if (self.pExq.numColors == 0):
             self.pExq.node[0].pHistogram = None
             for i in range(_EXQ_HASH_SIZE):
@@ -229,6 +424,7 @@ class ExoQuant:
                 self.optimize_palette(1)
 
         self.pExq.optimized = False
+        self.set_stage(prevStage)
     
     def get_mean_error(self):
         n = 0
@@ -293,8 +489,12 @@ class ExoQuant:
         if not self.pExq.optimized:
             self.optimize_palette(4)
 
+        stats = self.stats
+        prevStage = self.set_stage('map')
         for i in range(nPixels):
             pHist = self.find_histogram(pIn, i)
+            if stats is not None:
+                stats.count_cache('palIndex', pHist != None and pHist.palIndex != -1)
             if (pHist != None and pHist.palIndex != -1):
                 pOut[i] = pHist.palIndex
             else:
@@ -310,11 +510,44 @@ class ExoQuant:
                 if(pHist != None):
                     pHist.palIndex = i
         
+        self.set_stage(prevStage)
         return pOut
 
     def map_image_ordered(self, width, height, pIn):
         return self.map_image_dither(width, height, pIn, True)
 
+    def map_image_parallel(self, width, height, pIn, workers=None, strips=None):
+        # map_image_ordered over strips of rows in worker processes, with
+        # the pixels and indexes in shared memory. Strips have an even
+        # number of rows so the dither pattern lines up with the serial
+        # map, giving identical indexes.
+        if not self.pExq.optimized:
+            self.optimize_palette(4)
+        strips = strips or workers or 1
+        rows = -(-height // strips)
+        rows += rows & 1
+        if rows >= height or self.stats is not None:
+            # Counters are only collected in this process
+            return self.map_image_ordered(width, height, pIn)
+
+        avg = [
+            (node.avg.r, node.avg.g, node.avg.b, node.avg.a)
+            for node in self.pExq.node[:self.pExq.numColors]]
+        nPixels = width * height
+        src = shared_memory.SharedMemory(create=True, size=nPixels * 4)
+        out = shared_memory.SharedMemory(create=True, size=nPixels)
+        try:
+            src.buf[:nPixels * 4] = bytes(pIn[:nPixels * 4])
+            initargs = (src.name, out.name, width, avg, self.pExq.transparency)
+            with Pool(workers, initializer=init_map_worker, initargs=initargs) as pool:
+                pool.map(map_strip, [(y, min(y + rows, height)) for y in range(0, height, rows)])
+            return bytearray(out.buf[:nPixels])
+        finally:
+            src.close()
+            src.unlink()
+            out.close()
+            out.unlink()
+
     def map_image_random(self, nPixels, pIn):
         return self.map_image_dither(nPixels, 1, pIn, False)
     
@@ -327,11 +560,14 @@ class ExoQuant:
         tmp = ExqColor()
         pHist = None
         
-        pOut = [0] * (width * height)
+        # Palette indexes always fit a byte
+        pOut = bytearray(width * height)
 
         if not self.pExq.optimized:
             self.optimize_palette(4)
 
+        stats = self.stats
+        prevStage = self.set_stage('map')
         for y in range(height):
             for x in range(width):
                 index = y * width + x
@@ -353,6 +589,9 @@ class ExoQuant:
                     p.g *= p.a 
                     p.b *= p.a
 
+                if stats is not None:
+                    stats.count_cache('ditherScale', pHist != None and pHist.ditherScale.r >= 0)
+                    stats.count_cache('ditherIndex', pHist != None and pHist.ditherIndex[d] >= 0)
                 if pHist == None or pHist.ditherScale.r < 0:
                     i = self.find_nearest_color(p)
                     scale.r = self.pExq.node[i].avg.r - p.r
@@ -408,6 +647,7 @@ class ExoQuant:
                     if pHist != None:
                         pHist.ditherIndex[d] = pOut[index]
             
+        self.set_stage(prevStage)
         return pOut
     
     def sum_node(self, pNode):
@@ -541,6 +781,7 @@ class ExoQuant:
         pCur = None
 
         self.pExq.optimized = True
+        prevStage = self.set_stage('optimize')
 
         for n in range(iter):
             for i in range(self.pExq.numColors):
@@ -554,11 +795,176 @@ class ExoQuant:
                     pCur = pCur.pNextInHash
             for i in range(self.pExq.numColors):
                 self.sum_node(self.pExq.node[i])
+        self.set_stage(prevStage)
+
+    def quantize_from_palette(self, pPal, nColors, maxIter=4, keepDist=8):
+        # Warm start: seed node i from palette entry i (a previous
+        # get_palette result) and refine from there. Entries that stay
+        # within keepDist (0-255 per channel) of their seed keep it exactly
+        # and every entry keeps its index.
+        if nColors > 256:
+            nColors = 256
+
+        self.pExq.numColors = nColors
+        self.seed = [ExqColor() for i in range(nColors)]
+        self.keepDist = keepDist / 255.9
+        for i in range(nColors):
+            # Seed mid step so get_palette truncates back to the same value
+            pNode = self.pExq.node[i]
+            pNode.avg.r = (pPal[i * 4 + 0] + 0.5) * _EXQ_SCALE_R / 255.9
+            pNode.avg.g = (pPal[i * 4 + 1] + 0.5) * _EXQ_SCALE_G / 255.9
+            pNode.avg.b = (pPal[i * 4 + 2] + 0.5) * _EXQ_SCALE_B / 255.9
+            pNode.avg.a = (pPal[i * 4 + 3] + 0.5) * _EXQ_SCALE_A / 255.9
+            if self.pExq.transparency:
+                pNode.avg.r *= pNode.avg.a
+                pNode.avg.g *= pNode.avg.a
+                pNode.avg.b *= pNode.avg.a
+            seed = self.seed[i]
+            seed.r, seed.g, seed.b, seed.a = pNode.avg.r, pNode.avg.g, pNode.avg.b, pNode.avg.a
+
+        iterations = self.refine_palette(maxIter)
+        self.seed = None
+        return iterations
+
+    def keep_seed(self, i):
+        pNode = self.pExq.node[i]
+        seed = self.seed[i]
+        if (abs(pNode.avg.r - seed.r) <= self.keepDist * _EXQ_SCALE_R and
+                abs(pNode.avg.g - seed.g) <= self.keepDist * _EXQ_SCALE_G and
+                abs(pNode.avg.b - seed.b) <= self.keepDist * _EXQ_SCALE_B and
+                abs(pNode.avg.a - seed.a) <= self.keepDist * _EXQ_SCALE_A):
+            pNode.avg.r, pNode.avg.g, pNode.avg.b, pNode.avg.a = seed.r, seed.g, seed.b, seed.a
+
+    def refine_palette(self, maxIter):
+        # optimize_palette for a warm start. Every histogram entry keeps
+        # its node, an upper bound on the distance to it and a lower bound
+        # on the distance to any other node. It is only searched again
+        # once the nodes moved far enough to break the bounds, and only
+        # nodes that gained or lost entries are averaged again. Stops as
+        # soon as no entry changes node, returns the iterations used.
+        self.pExq.optimized = True
+        prevStage = self.set_stage('optimize')
+
+        entries = []
+        for i in range(_EXQ_HASH_SIZE):
+            pCur = self.pExq.pHash[i]
+            while pCur != None:
+                entries.append(pCur)
+                pCur = pCur.pNextInHash
+        nearest = [0] * len(entries)
+        upper = [0.0] * len(entries)
+        lower = [0.0] * len(entries)
+        for k, pCur in enumerate(entries):
+            nearest[k], upper[k], lower[k] = self.find_nearest_pair(pCur.color)
+
+        changed = set(range(self.pExq.numColors))
+        for n in range(maxIter):
+            moved = self.update_nodes(entries, nearest, changed)
+            if n == maxIter - 1:
+                break
+            maxMove = max(moved)
+            changed = set()
+            for k, pCur in enumerate(entries):
+                j = nearest[k]
+                upper[k] += moved[j]
+                lower[k] -= maxMove
+                if upper[k] < lower[k]:
+                    continue
+                i, upper[k], lower[k] = self.find_nearest_pair(pCur.color)
+                if i != j:
+                    nearest[k] = i
+                    changed.add(i)
+                    changed.add(j)
+            if not changed:
+                self.set_stage(prevStage)
+                return n + 1
+
+        self.set_stage(prevStage)
+        return maxIter
+
+    def update_nodes(self, entries, nearest, changed):
+        # Rebuild and average the entry lists of the changed nodes,
+        # returns how far every node moved
+        node = self.pExq.node
+        for i in changed:
+            node[i].pHistogram = None
+        for pCur, j in zip(entries, nearest):
+            if j in changed:
+                pCur.pNext = node[j].pHistogram
+                node[j].pHistogram = pCur
+
+        moved = [0.0] * self.pExq.numColors
+        for i in changed:
+            avg = node[i].avg
+            r, g, b, a = avg.r, avg.g, avg.b, avg.a
+            self.average_node(node[i])
+            if self.seed is not None:
+                self.keep_seed(i)
+            moved[i] = math.sqrt((avg.r - r) ** 2 + (avg.g - g) ** 2 + (avg.b - b) ** 2 + (avg.a - a) ** 2)
+        return moved
+
+    def average_node(self, pNode):
+        # The average and error of sum_node, without the split search
+        n = 0
+        fsum = ExqColor()
+        fsum2 = ExqColor()
+
+        pCur = pNode.pHistogram
+        while pCur != None:
+            n += pCur.num
+            fsum.r += pCur.color.r * pCur.num
+            fsum.g += pCur.color.g * pCur.num
+            fsum.b += pCur.color.b * pCur.num
+            fsum.a += pCur.color.a * pCur.num
+            fsum2.r += pCur.color.r * pCur.color.r * pCur.num
+            fsum2.g += pCur.color.g * pCur.color.g * pCur.num
+            fsum2.b += pCur.color.b * pCur.color.b * pCur.num
+            fsum2.a += pCur.color.a * pCur.color.a * pCur.num
+            pCur = pCur.pNext
+
+        pNode.num = n
+        if n == 0:
+            pNode.vdif = 0
+            pNode.err = 0
+            return
+
+        pNode.avg.r = fsum.r / n
+        pNode.avg.g = fsum.g / n
+        pNode.avg.b = fsum.b / n
+        pNode.avg.a = fsum.a / n
+        pNode.err = (
+            fsum2.r - fsum.r * pNode.avg.r + fsum2.g - fsum.g * pNode.avg.g +
+            fsum2.b - fsum.b * pNode.avg.b + fsum2.a - fsum.a * pNode.avg.a)
+
+    def find_nearest_pair(self, pColor):
+        # find_nearest_color, also returning the distance to the
+        # nearest color and to the second nearest
+        bestv = secondv = 16
+        besti = 0
+        if self.stats is not None:
+            self.stats.nearestCalls[self.stats.stage] += 1
+
+        for i in range(self.pExq.numColors):
+            avg = self.pExq.node[i].avg
+            dr = pColor.r - avg.r
+            dg = pColor.g - avg.g
+            db = pColor.b - avg.b
+            da = pColor.a - avg.a
+            v = dr * dr + dg * dg + db * db + da * da
+            if v < bestv:
+                secondv = bestv
+                bestv = v
+                besti = i
+            elif v < secondv:
+                secondv = v
+        return (besti, math.sqrt(bestv), math.sqrt(secondv))
 
     def find_nearest_color(self, pColor):
         dif = ExqColor()
         bestv = 16
         besti = 0
+        if self.stats is not None:
+            self.stats.nearestCalls[self.stats.stage] += 1
 
         for i in range(self.pExq.numColors):
             dif.r = pColor.r - self.pExq.node[i].avg.r
@@ -583,10 +989,17 @@ class ExoQuant:
         pCur = self.pExq.pHash[hash]
         while pCur != None and (pCur.ored != r or pCur.ogreen != g or pCur.oblue != b or pCur.oalpha != a):
             pCur = pCur.pNextInHash
+            if self.stats is not None:
+                self.stats.hashProbes += 1
+        if self.stats is not None:
+            self.stats.hashLookups += 1
 
         return pCur
 
-    def sort(self, ppHist, sortfunc):
+    def sort(self, ppHist, sortfunc, depth=1):
+        if self.stats is not None:
+            self.stats.sortCalls += 1
+            self.stats.sortMaxDepth = max(self.stats.sortMaxDepth, depth)
         pLow = None
         pHigh = None
         pCur = None
@@ -624,8 +1037,8 @@ class ExoQuant:
             ppHist = pLow
             return ppHist
 
-        pLow = self.sort(pLow, sortfunc)
-        pHigh = self.sort(pHigh, sortfunc)
+        pLow = self.sort(pLow, sortfunc, depth + 1)
+        pHigh = self.sort(pHigh, sortfunc, depth + 1)
 
         ppHist = pLow
         while pLow.pNext != None:
@@ -0,0 +1,239 @@
+from PIL import Image
+from exoquant import ExoQuant, build_histogram, _EXQ_SCALE_R, _EXQ_SCALE_G, _EXQ_SCALE_B, _EXQ_SCALE_A
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+EXOQUANT = 'exoquant'
+EXOQUANT_NP = 'exoquant-np'
+PIL_MEDIANCUT = 'pil-mediancut'
+PIL_OCTREE = 'pil-octree'
+PIL_LIBIMAGEQUANT = 'pil-libimagequant'
+DEFAULT_QUANTIZER = EXOQUANT
+
+# Opaque texel mask for bytes.translate
+ALPHA_MASK = bytes(0xFF if a >= 0x80 else 0 for a in range(256))
+
+# Refinement passes allowed when warm starting from a previous palette
+WARM_START_ITER = 8
+
+QUANTIZERS = {}
+
+def register_quantizer(name):
+    def register(cls):
+        cls.name = name
+        QUANTIZERS[name] = cls
+        return cls
+    return register
+
+def available_quantizers():
+    return [name for name, cls in QUANTIZERS.items() if cls.available()]
+
+def get_quantizer(name=DEFAULT_QUANTIZER, **kwargs):
+    if name not in QUANTIZERS:
+        raise ValueError(f'Unknown quantizer {name}, choose from {", ".join(QUANTIZERS)}')
+    if not QUANTIZERS[name].available():
+        raise ValueError(f'Quantizer {name} is not available on this machine')
+    return QUANTIZERS[name](**kwargs)
+
+
+class Quantizer(object):
+    # Base of the CI quantizers. Subclasses implement
+    #   feed(pData)                     add pixels to quantize
+    #   quantize(nColors, palette=None) palette: previous rgba32 palette to start from
+    #   palette(nColors)                the rgba32 palette
+    #   map(width, height, pData)       one palette index per pixel
+    # All pixel data and palettes are rgba32 byte streams.
+    name = None
+    # ExqStats stages the quantizer fills in, if it takes stats at all
+    stats_stages = ()
+
+    def __init__(self, workers=None, stats=None):
+        if stats is not None and not self.stats_stages:
+            raise ValueError(f'Quantizer {self.name} does not collect stats')
+        self.workers = workers
+        self.stats = stats
+
+    @classmethod
+    def available(cls):
+        return True
+
+
+@register_quantizer(EXOQUANT)
+class ExoQuantizer(Quantizer):
+    stats_stages = ('feed', 'quantize', 'optimize', 'map')
+
+    def __init__(self, workers=None, stats=None):
+        super().__init__(workers=workers, stats=stats)
+        self.exq = ExoQuant()
+        if stats is not None:
+            self.exq.enable_stats(stats)
+
+    def feed(self, pData):
+        self.exq.feed_histogram(build_histogram(pData, self.workers))
+
+    def quantize(self, nColors, palette=None):
+        if palette is not None:
+            if len(palette) != nColors * 4:
+                raise ValueError(f'Previous palette has {len(palette) // 4} colors, {nColors} needed')
+            self.exq.quantize_from_palette(palette, nColors, WARM_START_ITER)
+        else:
+            self.exq.quantize(nColors)
+
+    def palette(self, nColors):
+        return self.exq.get_palette(nColors)
+
+    def map(self, width, height, pData):
+        if self.workers:
+            index_data = self.exq.map_image_parallel(width, height, pData, self.workers)
+        else:
+            index_data = self.exq.map_image_ordered(width, height, pData)
+        self.exq.get_stats()
+        return index_data
+
+
+@register_quantizer(EXOQUANT_NP)
+class NumpyExoQuantizer(ExoQuantizer):
+    # ExoQuant palette with NumPy ordered dither mapping. Every unique
+    # color is mapped once per dither position with the same float
+    # math as map_image_dither, so the indexes are identical.
+    BLOCK = 0x1000
+    # Mapping happens in NumPy, outside the counters
+    stats_stages = ('feed', 'quantize', 'optimize')
+    DITHER = [-0.375, 0.125, 0.375, -0.125]
+    SCALE = [_EXQ_SCALE_R, _EXQ_SCALE_G, _EXQ_SCALE_B, _EXQ_SCALE_A]
+
+    @classmethod
+    def available(cls):
+        return np is not None
+
+    def nearest(self, colors, avg):
+        out = np.empty(len(colors), dtype=np.intp)
+        for i in range(0, len(colors), self.BLOCK):
+            dif = colors[i:i + self.BLOCK, None, :] - avg[None, :, :]
+            dist = dif[..., 0] * dif[..., 0] + dif[..., 1] * dif[..., 1] + dif[..., 2] * dif[..., 2] + dif[..., 3] * dif[..., 3]
+            out[i:i + self.BLOCK] = np.argmin(dist, axis=1)
+        return out
+
+    def map(self, width, height, pData):
+        pExq = self.exq.pExq
+        if not pExq.optimized:
+            self.exq.optimize_palette(4)
+        avg = np.array([
+            [node.avg.r, node.avg.g, node.avg.b, node.avg.a]
+            for node in pExq.node[:pExq.numColors]])
+
+        pixels = np.frombuffer(bytes(pData), dtype='<u4', count=width * height)
+        colors, inverse = np.unique(pixels, return_inverse=True)
+        p = colors.astype('<u4').view(np.uint8).reshape(-1, 4) / 255.0 * np.array(self.SCALE)
+        if pExq.transparency:
+            p[:, :3] *= p[:, 3:4]
+
+        i = self.nearest(p, avg)
+        scale = avg[i] - p
+        j = self.nearest(p - scale / 3, avg)
+        same = i == j
+        j[same] = self.nearest(p[same] - scale[same] * 3, avg)
+        scale = np.abs((avg[j] - avg[i]) * 0.8)
+        scale[i == j] = 0
+
+        table = np.stack([self.nearest(p + scale * d, avg) for d in self.DITHER], axis=1)
+        x = np.arange(width) & 1
+        y = (np.arange(height) & 1) * 2
+        dither = (y[:, None] + x[None, :]).ravel()
+        self.exq.get_stats()
+        return bytearray(table[inverse.ravel(), dither].astype(np.uint8).tobytes())
+
+
+class PillowQuantizer(Quantizer):
+    # Pillow's C quantizers, mapped without dithering. Texels with
+    # alpha under 0x80 always map to a transparent palette entry.
+    method = None
+    # Whether the method can quantize RGBA images itself
+    rgba = True
+
+    def feed(self, pData):
+        self.data = bytes(pData)
+
+    def image(self, width, height, pData):
+        return Image.frombytes('RGBA', (width, height), bytes(pData))
+
+    def has_alpha(self):
+        return any(a < 0x80 for a in self.data[3::4])
+
+    def quantize(self, nColors, palette=None):
+        n = len(self.data) // 4
+        if palette is not None:
+            # Pillow can't refine a palette, map against it as is, with
+            # the last entry made transparent if it has none and needs one
+            pal = list(palette[:nColors * 4])
+            if self.has_alpha() and all(a >= 0x80 for a in pal[3::4]):
+                pal[-4:] = [0, 0, 0, 0]
+            self.result_palette = pal
+        elif self.rgba:
+            # Entries come back with any alpha, snap them to the 1 bit
+            # alpha of the RGBA16 palette the same way texels are
+            img = self.image(n, 1, self.data).quantize(nColors, method=self.method, dither=Image.NONE)
+            pal = img.getpalette('RGBA')[:nColors * 4]
+            pal[3::4] = [0xFF if a >= 0x80 else 0 for a in pal[3::4]]
+            if self.has_alpha() and all(a for a in pal[3::4]):
+                pal[-4:] = [0, 0, 0, 0]
+            self.result_palette = pal
+        else:
+            # RGB only methods quantize the opaque texels, leaving the
+            # last entry for the transparent ones
+            alpha = self.has_alpha()
+            opaque = b''.join(
+                self.data[i:i + 3] for i in range(0, len(self.data), 4) if self.data[i + 3] >= 0x80)
+            pal = []
+            if opaque:
+                img = Image.frombytes('RGB', (len(opaque) // 3, 1), opaque)
+                rgb = img.quantize(nColors - alpha, method=self.method, dither=Image.NONE).getpalette()
+                pal = [v for i in range(0, len(rgb), 3) for v in rgb[i:i + 3] + [0xFF]][:(nColors - alpha) * 4]
+            self.result_palette = pal + [0] * ((nColors - alpha) * 4 - len(pal)) + [0, 0, 0, 0] * alpha
+
+    def palette(self, nColors):
+        pal = list(self.result_palette or [])[:nColors * 4]
+        return pal + [0] * (nColors * 4 - len(pal))
+
+    def map(self, width, height, pData):
+        # Opaque texels map by color to the opaque entries,
+        # the rest to the first transparent entry
+        pal = self.result_palette
+        opaque = [i for i in range(len(pal) // 4) if pal[i * 4 + 3] >= 0x80]
+        clear = [i for i in range(len(pal) // 4) if pal[i * 4 + 3] < 0x80]
+        data = bytes(pData)
+        n = len(data) // 4
+        out = bytes([clear[0] if clear else 0]) * n
+        if opaque:
+            pal_img = Image.new('P', (1, 1))
+            pal_img.putpalette([v for i in opaque for v in pal[i * 4:i * 4 + 3]])
+            img = self.image(width, height, data).convert('RGB')
+            idx = img.quantize(palette=pal_img, dither=Image.NONE).tobytes()
+            idx = idx.translate(bytes(opaque).ljust(0x100, b'\x00'))
+            if not clear:
+                return bytearray(idx)
+            keep = data[3::4].translate(ALPHA_MASK)
+            out = (int.from_bytes(idx, 'big') & int.from_bytes(keep, 'big')) | (
+                int.from_bytes(out, 'big') & ~int.from_bytes(keep, 'big'))
+            out = out.to_bytes(n, 'big')
+        return bytearray(out)
+
+@register_quantizer(PIL_MEDIANCUT)
+class PillowMedianCutQuantizer(PillowQuantizer):
+    method = Image.MEDIANCUT
+    rgba = False
+
+@register_quantizer(PIL_OCTREE)
+class PillowOctreeQuantizer(PillowQuantizer):
+    method = Image.FASTOCTREE
+
+@register_quantizer(PIL_LIBIMAGEQUANT)
+class PillowLibImageQuantQuantizer(PillowQuantizer):
+    method = Image.LIBIMAGEQUANT
+
+    @classmethod
+    def available(cls):
+        from PIL import features
+        return bool(features.check_feature('libimagequant'))
